@@ -13,9 +13,8 @@ from agents import baselineAgent, LSTM_Agent, DiscountedUCBAgent, SlidingWindowU
 import torch
 from torch import nn
 from torch.optim import Adam
+from torch.utils.data import DataLoader, TensorDataset
 import csv
-from random import shuffle
-from sklearn.utils import resample
 import matplotlib.pyplot as plt
 
 
@@ -36,8 +35,11 @@ agent = None
 l_rate = 0.001
 hidden_size = 16
 time_steps = 60
+batch_size = 256
 epochs = 5000
 patience = 10
+val_every = 5
+log_every = 50
 
 criterion = nn.MSELoss()
 np.random.seed(0)
@@ -52,7 +54,9 @@ validation_losses = []
 def create_training_traces(env, mode, inp):
     # Training
     env.reset(mode)
-    states = []
+    # the trace length is bounded by the episode length, so the trace is filled in place
+    states = np.empty((env.length, env.n_camera), dtype=np.float32)
+    n_states = 0
 
     if inp == 1:
         agent = baselineAgent(agent_type='strong')
@@ -72,19 +76,20 @@ def create_training_traces(env, mode, inp):
         init_action = np.random.rand(env.n_camera)
         reward, state, stop = env.step(init_action)
 
-    for t in tqdm(range(env.length), initial=2):
+    for t in tqdm(range(env.length), initial=2, mininterval=0.5, miniters=max(1, env.length // 200)):
         action = agent.get_action(state) if inp in [1, 5] else agent.get_action()
         reward, state, stop = env.step(action)
 
         if inp in [2, 3, 4]:  # UCB agents
             agent.update(action, state)
 
-        states.append(state)
+        states[t] = state
+        n_states = t + 1
 
         if stop:
             break
 
-    return states
+    return states[:n_states]
 
 def get_train_test(states, split_percent=0.7):
     n = len(states)
@@ -94,70 +99,72 @@ def get_train_test(states, split_percent=0.7):
     return train_states, test_states
 
 def get_XY(states, time_steps=1):
-    states = np.array(states)
-    X, Y = [], []
-    for i in range(len(states) - time_steps):
-        X.append(states[i : (i + time_steps)])
-        Y.append(states[i + time_steps])
-    return np.array(X), np.array(Y)
+    states = np.asarray(states, dtype=np.float32)
+    # X[i] = states[i:i + time_steps] as a zero-copy strided view, Y[i] = states[i + time_steps]
+    X = np.lib.stride_tricks.sliding_window_view(states, time_steps, axis=0)[:-1].transpose(0, 2, 1)
+    Y = states[time_steps:]
+    return X, Y
 
 import numpy as np
 
 def impute_missing_values(states, style):
-    imputed_states = []
+    # copy into one float array so the caller's traces are left untouched
+    imputed_states = np.array(states, dtype=np.float32)
+    mask = imputed_states < 0
     if style == 1:
-        # median imputation
-        for state in states:
-            median_values = np.median([v for v in state if v >= 0])
-            imputed_state = np.array([v if v >= 0 else median_values for v in state])
-            imputed_states.append(imputed_state)
+        # median imputation: sort each state with the missing cameras pushed to the end
+        # and average the two middle observed values (equal for an odd number of them)
+        n_observed = (~mask).sum(axis=1)
+        observed = np.sort(np.where(mask, np.inf, imputed_states), axis=1)
+        lower = np.take_along_axis(observed, ((n_observed - 1) // 2)[:, None], axis=1)[:, 0]
+        upper = np.take_along_axis(observed, (n_observed // 2)[:, None], axis=1)[:, 0]
+        fill_values = np.where(n_observed > 0, (lower + upper) / 2, np.nan)
+        np.copyto(imputed_states, fill_values[:, None], where=mask)
     elif style == 2:
-        # median imputation
-        for state in states:
-            median_values = np.mean([v for v in state if v >= 0])
-            imputed_state = np.array(
-                [v if v >= 0 else median_values for v in state])
-            imputed_states.append(imputed_state)
+        # mean imputation
+        fill_values = np.nanmean(np.where(mask, np.nan, imputed_states), axis=1)
+        np.copyto(imputed_states, fill_values[:, None], where=mask)
     elif style == 3:
         # linear interpolation
-        for state in states:
-            mask = state >= 0
-            x = np.where(mask)[0]
-            y = state[mask]
-            imputed_state = np.interp(np.arange(len(state)), x, y)
-            imputed_states.append(imputed_state)
+        for i, state in enumerate(imputed_states):
+            x = np.where(~mask[i])[0]
+            imputed_states[i] = np.interp(np.arange(len(state)), x, state[x])
     else:
         # nearest neighbor interpolation
-        for state in states:
-            mask = state >= 0
-            imputed_state = state.copy()
-            missing_indexes = np.where(~mask)[0]
-            non_missing_indexes = np.where(mask)[0]
+        for i, state in enumerate(imputed_states):
+            missing_indexes = np.where(mask[i])[0]
+            non_missing_indexes = np.where(~mask[i])[0]
             for idx in missing_indexes:
                 nearest_idx = non_missing_indexes[np.abs(non_missing_indexes - idx).argmin()]
-                imputed_state[idx] = state[nearest_idx]
-            imputed_states.append(imputed_state)
-    return np.array(imputed_states)
+                state[idx] = state[nearest_idx]
+    return imputed_states
+
+def partition_median(values):
+    # O(n) median via np.partition instead of the full sort done by np.median;
+    # NaN when no camera was observed, like np.median and impute_missing_values
+    if len(values) == 0:
+        return np.nan
+    k = len(values) // 2
+    if len(values) % 2:
+        return np.partition(values, k)[k]
+    middle = np.partition(values, [k - 1, k])
+    return (middle[k - 1] + middle[k]) / 2
 
 def imv(state, style):
+    mask = state >= 0
     if style == 1:
         # median imputation
-        median_value = np.median([v for v in state if v >= 0])
-        imputed_state = np.array([v if v >= 0 else median_value for v in state])
+        imputed_state = np.where(mask, state, partition_median(state[mask]))
     elif style == 2:
         # mean imputation
-        median_value = np.mean([v for v in state if v >= 0])
-        imputed_state = np.array(
-            [v if v >= 0 else median_value for v in state])
+        imputed_state = np.where(mask, state, np.mean(state[mask]))
     elif style == 3:
         # linear interpolation
-        mask = state >= 0
         x = np.where(mask)[0]
         y = state[mask]
         imputed_state = np.interp(np.arange(len(state)), x, y)
     else:
         # nearest neighbor interpolation
-        mask = state >= 0
         imputed_state = state.copy()
         missing_indexes = np.where(~mask)[0]
         non_missing_indexes = np.where(mask)[0]
@@ -169,11 +176,18 @@ def imv(state, style):
 
 
 def resample_data(X, Y):
-    X_resampled, Y_resampled = resample(X, Y, replace=True, n_samples=len(X) // 2, random_state=123)
-    c = list(zip(X_resampled, Y_resampled))
-    shuffle(c)
-    X_resampled, Y_resampled = zip(*c)
-    return X_resampled, Y_resampled
+    # bootstrap half of the samples (with replacement) in a shuffled order
+    rng = np.random.default_rng(123)
+    idx = rng.integers(0, len(X), size=len(X) // 2)
+    rng.shuffle(idx)
+    return X[idx], Y[idx]
+
+def to_device(array):
+    # zero-copy view of the host array, page-locked on CUDA so the copy runs asynchronously
+    tensor = torch.from_numpy(np.ascontiguousarray(array, dtype=np.float32))
+    if device.type == 'cuda':
+        tensor = tensor.pin_memory()
+    return tensor.to(device, non_blocking=True)
 
 
 if __name__ == '__main__':
@@ -187,6 +201,15 @@ if __name__ == '__main__':
     train_data = impute_missing_values(train_data, style=imp)
     test_data = impute_missing_values(test_data, style=imp)
 
+    # mixed precision on CUDA only, MPS autocast support is limited; the parameters stay fp32
+    # so small Adam updates are not lost. bf16 autocast on GPUs that support it keeps the fp32
+    # exponent range and needs no loss scaling, otherwise fp16 autocast with a GradScaler.
+    # bf16 tensor cores need Ampere (compute capability 8.0) or newer; is_bf16_supported()
+    # also reports emulated bf16 on older GPUs, so the capability is checked directly
+    use_amp = device.type == 'cuda'
+    use_bf16 = use_amp and torch.cuda.get_device_capability(device)[0] >= 8
+    amp_dtype = torch.bfloat16 if use_bf16 else torch.float16
+
     lstm_agent = LSTM_Agent(env.n_camera, hidden_size, env.n_camera).to(device)
     optimizer = Adam(lstm_agent.parameters(), lr=l_rate)
 
@@ -194,54 +217,90 @@ if __name__ == '__main__':
     testX, testY = get_XY(test_data, time_steps)
     trainX, trainY = resample_data(trainX, trainY)
 
-    # convert to np array
-    trainX = np.array(trainX)
-    trainY = np.array(trainY)
-
-
-    trainX = torch.tensor(trainX, dtype=torch.float32).to(device)
-    trainY = torch.tensor(trainY, dtype=torch.float32).to(device)
-    testX = torch.tensor(testX, dtype=torch.float32).to(device)
-    testY = torch.tensor(testY, dtype=torch.float32).to(device)
+    # training samples stay on the host and are streamed to the device in mini-batches
+    trainX = torch.from_numpy(np.ascontiguousarray(trainX, dtype=np.float32))
+    trainY = torch.from_numpy(np.ascontiguousarray(trainY, dtype=np.float32))
+    train_loader = DataLoader(TensorDataset(trainX, trainY), batch_size=batch_size, shuffle=True,
+                              drop_last=True, pin_memory=(device.type == 'cuda'))
+    testX = to_device(testX)
+    testY = to_device(testY)
+
+    # the device-generic torch.amp.GradScaler exists from torch 2.3, older versions only
+    # have the (since deprecated) CUDA one
+    use_scaler = use_amp and not use_bf16
+    if hasattr(getattr(torch, 'amp', None), 'GradScaler'):
+        scaler = torch.amp.GradScaler('cuda', enabled=use_scaler)
+    else:
+        scaler = torch.cuda.amp.GradScaler(enabled=use_scaler)
+
+    # fuse the LSTM gates on CUDA for the fixed training batch shape (drop_last=True);
+    # validation runs eagerly, since compiled wrappers of the same forward share one cache
+    # and the full test batch would recompile it with dynamic shapes
+    train_lstm = lstm_agent
+    if hasattr(torch, 'compile') and device.type == 'cuda':
+        train_lstm = torch.compile(lstm_agent, mode='max-autotune')
+
+    # zero initial states are allocated once: the LSTM never writes into them,
+    # so the same buffers serve every training batch and validation pass
+    h0_train, c0_train = lstm_agent.init_hidden_cell_states(batch_size=batch_size)
+    h0_val, c0_val = lstm_agent.init_hidden_cell_states(batch_size=testX.size(0))
+
+    # per-epoch losses stay on the device and are copied to the host every log_every epochs,
+    # since every device-to-host read synchronizes the stream
+    loss_log = torch.empty(epochs, device=device)
+    val_loss_log = torch.empty(epochs, device=device)
+    n_logged = 0
 
     # Training loop
     print('Training LSTM Agent')
+    last_val_epoch = 0
     for epoch in range(epochs):
-        hidden_state, cell_state = lstm_agent.init_hidden_cell_states(
-            batch_size=trainX.size(0))
-        hidden_state = hidden_state.to(device)
-        cell_state = cell_state.to(device)
-        optimizer.zero_grad()
-        outputs, (hidden_state, cell_state) = lstm_agent(trainX, (
-        hidden_state, cell_state))
-        loss = criterion(outputs, trainY)
-        loss.backward()
-
-        optimizer.step()
-
-        # Validation
-        val_outputs, (_, _) = lstm_agent(testX,
-                                         lstm_agent.init_hidden_cell_states(
-                                             batch_size=testX.size(0)))
-        hidden_state = hidden_state.to(device)
-        cell_state = cell_state.to(device)
-        val_loss = criterion(val_outputs, testY)
-        validation_losses.append(round(val_loss.item(), 3))
-        training_losses.append(round(loss.item(), 3))
-
-        # Early stopping
-        if val_loss < best_val_loss:
-            best_val_loss = val_loss
-            epochs_without_improvement = 0
-            best_epoch = epoch
-        else:
-            epochs_without_improvement += 1
-
-
-        print(
-            f'Epoch: {epoch + 1}, Training Loss: {round(loss.item(), 3)}, Validation Loss: {round(val_loss.item(), 3)}')
-
-        if epochs_without_improvement >= patience:
+        lstm_agent.train()
+        running_loss = torch.zeros((), device=device)
+        for xb, yb in train_loader:
+            xb = xb.to(device, non_blocking=True)
+            yb = yb.to(device, non_blocking=True)
+            optimizer.zero_grad(set_to_none=True)
+            with torch.autocast('cuda', dtype=amp_dtype, enabled=use_amp):
+                outputs, _ = train_lstm(xb, (h0_train, c0_train))
+                batch_loss = criterion(outputs.float(), yb)
+            scaler.scale(batch_loss).backward()
+
+            scaler.step(optimizer)
+            scaler.update()
+            running_loss += batch_loss.detach().float() * xb.size(0)
+        loss = running_loss / (len(train_loader) * batch_size)
+
+        # Validation, every val_every epochs and on each of the last epochs;
+        # in between the previous validation loss is carried forward
+        if epoch % val_every == 0 or epoch >= epochs - patience:
+            lstm_agent.eval()
+            with torch.autocast('cuda', dtype=amp_dtype, enabled=use_amp), torch.inference_mode():
+                val_outputs, _ = lstm_agent(testX, (h0_val, c0_val))
+                val_loss = criterion(val_outputs.float(), testY)
+
+            # Early stopping (patience is still counted in epochs)
+            if val_loss < best_val_loss:
+                best_val_loss = val_loss
+                epochs_without_improvement = 0
+                best_epoch = epoch
+            else:
+                epochs_without_improvement += epoch - last_val_epoch
+            last_val_epoch = epoch
+        loss_log[epoch] = loss
+        val_loss_log[epoch] = val_loss
+
+        early_stop = epochs_without_improvement >= patience
+        if (epoch + 1) % log_every == 0 or early_stop or epoch == epochs - 1:
+            for i, (train_l, val_l) in enumerate(zip(loss_log[n_logged:epoch + 1].tolist(),
+                                                     val_loss_log[n_logged:epoch + 1].tolist()), start=n_logged):
+                training_losses.append(round(train_l, 3))
+                validation_losses.append(round(val_l, 3))
+                print(
+                    f'Epoch: {i + 1}, Training Loss: {round(train_l, 3)}, Validation Loss: {round(val_l, 3)}')
+            n_logged = epoch + 1
+
+        if early_stop:
             print("Early stopping")
             break
 
@@ -251,45 +310,72 @@ if __name__ == '__main__':
     init_action = np.random.rand(env.n_camera)
     reward, state, stop = env.step(init_action)
 
+    # the rollout only runs inference, so on bf16-capable GPUs it uses a bf16 copy of the model
+    rollout_lstm = lstm_agent.eval()
+    if use_bf16:
+        rollout_lstm = LSTM_Agent(env.n_camera, hidden_size, env.n_camera).to(device=device, dtype=torch.bfloat16)
+        rollout_lstm.load_state_dict(lstm_agent.state_dict())
+        rollout_lstm.eval()
+
     # Initialize the hidden and cell states for the LSTM agent
-    hidden_state, cell_state = lstm_agent.init_hidden_cell_states(
+    hidden_state, cell_state = rollout_lstm.init_hidden_cell_states(
         batch_size=1)
     hidden_state = hidden_state.to(device)
     cell_state = cell_state.to(device)
 
+    # scripted and frozen copy of the trained model for the step-by-step rollout
+    scripted_lstm = torch.jit.freeze(torch.jit.script(rollout_lstm))
+
+    # host staging buffer for the per-step input, with the batch and sequence dimensions,
+    # a matching device-side input and a host buffer for the returned scores
+    state_buf = torch.empty(1, 1, env.n_camera, pin_memory=(device.type == 'cuda'))
+    input_state = torch.empty(1, 1, env.n_camera, device=device, dtype=rollout_lstm.dense.weight.dtype)
+    action_buf = torch.empty(env.n_camera, pin_memory=(device.type == 'cuda'))
+
+    # a few dummy steps at the rollout shape let cuDNN pick its kernels and the TorchScript
+    # executor optimize the graph before inference times are measured
+    with torch.inference_mode():
+        for _ in range(3):
+            scripted_lstm(torch.zeros_like(input_state), rollout_lstm.init_hidden_cell_states(batch_size=1))
+
     inference_times = []
 
     reward_on_time = []
-    for t in tqdm(range(env.length), initial=2):
-        # Prepare the input state for the LSTM agent
-        # print(state)
-        input_state = torch.tensor(state, dtype=torch.float32).unsqueeze(
-            0).unsqueeze(0).to(
-            device)  # Add the batch and sequence dimensions
+    # the rollout is closed-loop: the predicted scores decide which cameras are checked,
+    # and therefore which entries of the next state are observed, so the trace cannot be
+    # collected up front and fed through the LSTM as a single sequence
+    # no autograd bookkeeping for the whole rollout
+    with torch.inference_mode():
+        for t in tqdm(range(env.length), initial=2, mininterval=0.5, miniters=max(1, env.length // 200)):
+            # Prepare the input state for the LSTM agent
+            # print(state)
+            state_buf[0, 0].copy_(torch.from_numpy(state))
+            input_state.copy_(state_buf, non_blocking=True)
 
-        # Measure inference time
-        start_time = time.time()
+            # Measure inference time
+            start_time = time.time()
 
-        # Get the action from the LSTM agent, passing the hidden and cell states
-        action, (hidden_state, cell_state) = lstm_agent(input_state, (
-        hidden_state, cell_state))
+            # Get the action from the LSTM agent, passing the hidden and cell states
+            action, (hidden_state, cell_state) = scripted_lstm(input_state, (
+            hidden_state, cell_state))
 
-        end_time = time.time()
+            end_time = time.time()
 
-        # Calculate and append inference time
-        inference_time = (end_time - start_time) * 1000  # convert to ms
-        inference_times.append(inference_time)
+            # Calculate and append inference time
+            inference_time = (end_time - start_time) * 1000  # convert to ms
+            inference_times.append(inference_time)
 
-        action = action.squeeze().detach().cpu().numpy()
+            action_buf.copy_(action.view(-1))
+            action = action_buf.numpy()
 
-        # Perform the action in the environment
-        reward, state, stop = env.step(action)
-        reward_on_time.append(reward)
-        state = impute_missing_values([state], imp)[0]
+            # Perform the action in the environment
+            reward, state, stop = env.step(action)
+            reward_on_time.append(reward)
+            state = imv(state, imp)
 
 
-        if stop:
-            break
+            if stop:
+                break
 
     average_inference_time = statistics.mean(inference_times)
 
@@ -3,6 +3,9 @@ RNNtest script for 'Resource Optimization for Facial Recognition Systems (ROFARS
 author: Jasper Bruin @ UvA-MNS
 date: 23/02/2023
 """
+import os
+import csv
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
@@ -11,6 +14,45 @@ from agents import SlidingWindowUCBAgent, UCBAgent, DiscountedUCBAgent, baseline
 import time
 
 
+# environment of a sweep worker process, loaded once per worker by _init_worker
+_worker_env = None
+
+
+def _init_worker():
+    global _worker_env
+    _worker_env = ROFARS_v1()
+
+
+def _train_ucb(agent, seed):
+    # one training rollout in a sweep worker, seeded so that results are reproducible
+    np.random.seed(seed)
+    env = _worker_env
+    agent.initialize(env.n_camera)
+    env.reset(mode='train')
+
+    for t in range(env.length):
+        action = agent.get_action()
+        reward, state, stop = env.step(action)
+
+        # Update the UCB Agent
+        agent.update(action, state)
+
+        if stop:
+            break
+
+    return env.get_total_reward()
+
+
+# the agents get the task seed too: left unseeded, their generators would be drawn from
+# whatever global state earlier tasks in the same worker left behind
+def _train_sw_ucb(window_size):
+    return _train_ucb(SlidingWindowUCBAgent(window_size=window_size * 60, seed=window_size), seed=window_size)
+
+
+def _train_d_ucb(gamma, seed):
+    return _train_ucb(DiscountedUCBAgent(gamma=gamma, seed=seed), seed=seed)
+
+
 def SWUCBExperiment():
     np.random.seed(0)
     env = ROFARS_v1()
@@ -21,25 +63,12 @@ def SWUCBExperiment():
     window_sizes = []
     total_rewards = []
 
-    # Find the best sliding window in the training session
-    for window_size in range(1, max_window_size + 1):
-        agent = SlidingWindowUCBAgent(window_size=window_size * 60)
-        agent.initialize(env.n_camera)
-
-        # Training loop
-        env.reset(mode='train')
-
-        for t in tqdm(range(env.length), initial=2):
-            action = agent.get_action()
-            reward, state, stop = env.step(action)
-
-            # Update the UCB Agent
-            agent.update(action, state)
-
-            if stop:
-                break
+    # Find the best sliding window in the training session (window sizes are trained in parallel)
+    candidates = range(1, max_window_size + 1)
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_worker) as ex:
+        results = list(ex.map(_train_sw_ucb, candidates))
 
-        total_reward = env.get_total_reward()
+    for window_size, total_reward in zip(candidates, results):
         print(f'=== TRAINING === window size: {window_size}')
         print('[total reward]:', total_reward)
 
@@ -57,7 +86,7 @@ def SWUCBExperiment():
     agent.initialize(env.n_camera)
     env.reset(mode='test')
 
-    for t in tqdm(range(env.length), initial=2):
+    for t in tqdm(range(env.length), initial=2, mininterval=0.5, miniters=max(1, env.length // 200)):
         action = agent.get_action()
         reward, state, stop = env.step(action)
 
@@ -97,25 +126,12 @@ def DiscountedUCBExperiment():
     gammas = []
     total_rewards = []
 
-    # Find the best gamma in the training session
-    for gamma in np.arange(min_gamma, max_gamma, gamma_step):
-        agent = DiscountedUCBAgent(gamma=gamma)
-        agent.initialize(env.n_camera)
+    # Find the best gamma in the training session (gammas are trained in parallel)
+    candidates = np.arange(min_gamma, max_gamma, gamma_step)
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=_init_worker) as ex:
+        results = list(ex.map(_train_d_ucb, candidates, range(len(candidates))))
 
-        # Training loop
-        env.reset(mode='train')
-
-        for t in tqdm(range(env.length), initial=2):
-            action = agent.get_action()
-            reward, state, stop = env.step(action)
-
-            # Update the UCB Agent
-            agent.update(action, state)
-
-            if stop:
-                break
-
-        total_reward = env.get_total_reward()
+    for gamma, total_reward in zip(candidates, results):
         print(f'=== TRAINING gamma {gamma} ===')
         print('[total reward]:', total_reward)
 
@@ -133,7 +149,7 @@ def DiscountedUCBExperiment():
     agent.initialize(env.n_camera)
     env.reset(mode='test')
 
-    for t in tqdm(range(env.length), initial=2):
+    for t in tqdm(range(env.length), initial=2, mininterval=0.5, miniters=max(1, env.length // 200)):
         action = agent.get_action()
         reward, state, stop = env.step(action)
 
@@ -189,7 +205,7 @@ def SWUCBOpt(agent_type):
 
     # Training loop
     env.reset(mode='train')
-    for t in tqdm(range(env.length), initial=2):
+    for t in tqdm(range(env.length), initial=2, mininterval=0.5, miniters=max(1, env.length // 200)):
         action = agent.get_action()
         reward, state, stop = env.step(action)
 
@@ -214,7 +230,7 @@ def SWUCBOpt(agent_type):
 
     env.reset(mode='test')
 
-    for t in tqdm(range(env.length), initial=2):
+    for t in tqdm(range(env.length), initial=2, mininterval=0.5, miniters=max(1, env.length // 200)):
         action = agent.get_action()
         reward, state, stop = env.step(action)
 
@@ -252,7 +268,7 @@ def timeexperiment(agent_type):
 
     inference_times = []
 
-    for t in tqdm(range(env.length), initial=2):
+    for t in tqdm(range(env.length), initial=2, mininterval=0.5, miniters=max(1, env.length // 200)):
         start_time = time.time()
         action = agent.get_action()
         end_time = time.time()
@@ -271,7 +287,7 @@ def timeexperiment(agent_type):
 
     return np.mean(inference_times)
 
-def robustness_test(agent_type, budget_ratios):
+def robustness_test(agent_type, budget_ratios, env=None):
     if agent_type == 1:
         print("UCB-1")
     elif agent_type == 2:
@@ -290,9 +306,13 @@ def robustness_test(agent_type, budget_ratios):
 
     rewards = []
 
+    # the camera streams do not depend on the budget, so they are loaded once;
+    # callers testing several agent types can pass in one shared environment
+    if env is None:
+        env = ROFARS_v1()
+
     for budget_ratio in budget_ratios:
-        env = ROFARS_v1(budget_ratio=budget_ratio)
-        env.reset(mode='test')
+        env.reset(mode='test', budget_ratio=budget_ratio)
 
         if agent_type == 1:
             agent = UCBAgent()
@@ -350,7 +370,7 @@ def robustness_test(agent_type, budget_ratios):
             init_action = np.random.rand(env.n_camera)
             reward, state, stop = env.step(init_action)
 
-            for t in tqdm(range(env.length), initial=2):
+            for t in range(env.length):
 
                 action = agent.get_action(state)
                 reward, state, stop = env.step(action)
@@ -368,7 +388,7 @@ def robustness_test(agent_type, budget_ratios):
             init_action = np.random.rand(env.n_camera)
             reward, state, stop = env.step(init_action)
 
-            for t in tqdm(range(env.length), initial=2):
+            for t in range(env.length):
 
                 action = agent.get_action(state)
                 reward, state, stop = env.step(action)
@@ -383,3 +403,30 @@ def robustness_test(agent_type, budget_ratios):
 
     return budget_ratios, rewards
 
+
+def robustness_sweep(agent_types, budget_ratios, path='experiments_data/robustness.csv'):
+    # all agent types share one environment; each agent's rewards are appended to the
+    # csv as soon as its budget sweep finishes, so an interrupted sweep keeps its results
+    env = ROFARS_v1()
+    results = {}
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if not os.path.isfile(path) or os.path.getsize(path) == 0:
+        with open(path, mode='w', newline='') as file:
+            csv.writer(file).writerow(['agent_type', 'budget_ratio', 'total_reward'])
+
+    for agent_type in agent_types:
+        _, rewards = robustness_test(agent_type, budget_ratios, env=env)
+        results[agent_type] = rewards
+
+        with open(path, mode='a', newline='') as file:
+            writer = csv.writer(file)
+            for budget_ratio, reward in zip(budget_ratios, rewards):
+                writer.writerow([agent_type, budget_ratio, reward])
+
+    return budget_ratios, results
+
+
+if __name__ == '__main__':
+    # total test reward of UCB-1, SW-UCB, D-UCB and the simple and strong baselines per budget ratio
+    robustness_sweep([1, 2, 3, 4, 5], np.round(np.arange(0.1, 1.0, 0.1), 1))
@@ -5,11 +5,16 @@ date: 23/02/2023
 """
 
 
-from collections import deque
+from typing import Tuple
 import numpy as np
 import torch
 import torch.nn as nn
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 def select_device():
     """
@@ -33,6 +38,102 @@ def select_device():
 
 device = select_device()
 
+# allow TF32 tensor-core math for fp32 matmuls and cuDNN's LSTM kernels on Ampere+ GPUs,
+# MPS and CPU are not affected by these settings
+if device.type == 'cuda':
+    torch.set_float32_matmul_precision('high')
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+
+
+if numba is not None:
+    # with numba installed the updates run as single compiled loops over the arms
+    # instead of a chain of NumPy calls with temporaries
+    @numba.njit(cache=True, fastmath=True)
+    def ucb_update(counts, values, state):
+        """
+        Incremental mean update of the UCB1 statistics for the observed (non-negative) arms, in place.
+        """
+        for i in range(state.shape[0]):
+            if state[i] >= 0:
+                counts[i] += 1
+                values[i] += (state[i] - values[i]) / counts[i]
+
+    @numba.njit(cache=True, fastmath=True)
+    def discounted_ucb_update(counts, values, discounted_counts, discounted_rewards, state, weight):
+        """
+        Add the observed (non-negative) rewards to the D-UCB statistics with the given weight, in place.
+        """
+        for i in range(state.shape[0]):
+            if state[i] >= 0:
+                counts[i] += 1
+                values[i] += state[i]
+                discounted_counts[i] += weight
+                discounted_rewards[i] += weight * state[i]
+
+    # no fastmath here, the score of an arm without observations is inf
+    @numba.njit(cache=True)
+    def sliding_window_ucb_scores(rewards_sum, counts_sum, log_t, c, out):
+        """
+        SW-UCB scores of all arms written into out; an arm unobserved in the window scores inf.
+        """
+        for i in range(out.shape[0]):
+            if counts_sum[i] > 0:
+                out[i] = rewards_sum[i] / counts_sum[i] + c * np.sqrt(2 * log_t / counts_sum[i])
+            else:
+                out[i] = np.inf
+        return out
+
+else:
+    # without numba, the same operations as whole-array NumPy calls
+    def ucb_update(counts, values, state):
+        """
+        Incremental mean update of the UCB1 statistics for the observed (non-negative) arms, in place.
+        """
+        mask = state >= 0
+        counts += mask
+        safe_counts = np.where(mask, counts, 1)
+        values += np.where(mask, (state - values) / safe_counts, 0.0)
+
+    def discounted_ucb_update(counts, values, discounted_counts, discounted_rewards, state, weight):
+        """
+        Add the observed (non-negative) rewards to the D-UCB statistics with the given weight, in place.
+        """
+        mask = state >= 0
+        rewards = np.where(mask, state, 0.0)
+        counts += mask
+        values += rewards
+        discounted_counts += weight * mask
+        discounted_rewards += weight * rewards
+
+    def sliding_window_ucb_scores(rewards_sum, counts_sum, log_t, c, out):
+        """
+        SW-UCB scores of all arms written into out; an arm unobserved in the window scores inf.
+        """
+        # 0/0 when log_t is 0 (first step or a window of 1), those arms are set to inf below
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(2 * log_t, counts_sum, out=out)
+        np.sqrt(out, out=out)
+        out *= c
+        out += rewards_sum / np.maximum(counts_sum, 1)
+        np.copyto(out, np.inf, where=counts_sum == 0)
+        return out
+
+
+def make_rng(seed=None):
+    """
+    Create a NumPy random Generator for an agent.
+
+    Without a seed, the generator is seeded from the legacy global state, so that
+    np.random.seed() in the experiment scripts keeps runs reproducible.
+
+    Returns:
+        np.random.Generator : The agent's random generator.
+    """
+    if seed is None:
+        seed = np.random.randint(0, 2**32, dtype=np.uint64)
+    return np.random.default_rng(seed)
+
 
 class baselineAgent:
     """
@@ -47,27 +148,30 @@ class baselineAgent:
         The previous state observed by the agent.
     theta : float
         Parameter for the strong agent to replace -1 values in the previous state.
+    seed : int, optional
+        Seed of the agent's random generator, drawn from the global NumPy state if omitted.
     """
-    def __init__(self, theta=0, agent_type='strong'):
+    def __init__(self, theta=0, agent_type='strong', seed=None):
         assert agent_type in ['simple', 'strong']
         self.agent_type = agent_type
         self.prev_state = None
         self.theta = theta
+        self._rng = make_rng(seed)
 
     def initialize(self, n_actions):
         pass
 
     def get_action(self, state):
         # store previous state
-        self.prev_state = state
+        self.prev_state = np.asarray(state)
 
         if self.agent_type=='simple':
             # random action
-            action = np.random.rand(len(state))
+            action = self._rng.random(self.prev_state.shape[0], dtype=np.float32)
 
         elif self.agent_type=='strong':
             # use previous states as scores (-1 is replaced by the learned param theta)
-            action = np.array([v if v>=0 else self.theta for v in self.prev_state])
+            action = np.where(self.prev_state >= 0, self.prev_state, self.theta)
 
         return action
 
@@ -79,57 +183,61 @@ class SlidingWindowUCBAgent:
     ----------
     window_size : int
         The size of the sliding window for recent rewards and counts.
+    seed : int, optional
+        Seed of the agent's random generator, drawn from the global NumPy state if omitted.
     """
-    def __init__(self, window_size=1000):
+    def __init__(self, window_size=1000, seed=None):
         self.counts = None
-        self.values = None
         self.c = 3
         self.window_size = window_size
         self.recent_rewards = None
         self.recent_counts = None
         self.recent_rewards_sum = None
         self.recent_counts_sum = None
+        self.head = 0
+        self._all_seen = False
+        self._rng = make_rng(seed)
         self.total_time_steps = 0
 
     def initialize(self, n_actions):
-        self.counts = np.zeros(n_actions)
-        self.values = np.zeros(n_actions)
-        self.recent_rewards = [deque(maxlen=self.window_size) for _ in range(n_actions)]
-        self.recent_counts = [deque(maxlen=self.window_size) for _ in range(n_actions)]
-        self.recent_rewards_sum = np.zeros(n_actions)
-        self.recent_counts_sum = np.zeros(n_actions)
+        self.counts = np.zeros(n_actions, dtype=np.float32)
+        # ring buffers with one row per time step in the window, row `head` is the oldest
+        self.recent_rewards = np.zeros((self.window_size, n_actions), dtype=np.float32)
+        self.recent_counts = np.zeros((self.window_size, n_actions), dtype=np.int8)
+        self.head = 0
+        self.recent_rewards_sum = np.zeros(n_actions, dtype=np.float32)
+        self.recent_counts_sum = np.zeros(n_actions, dtype=np.float32)
+        self._all_seen = False
 
     def get_action(self):
-        if self.counts.min() == 0:
-            idx = np.random.choice(np.where(self.counts == 0)[0])
-            action = np.zeros(len(self.values))
+        # counts never decrease, so the scan for unseen arms stops once all have been seen
+        if not self._all_seen and self.counts.min() == 0:
+            unseen = np.flatnonzero(self.counts == 0)
+            idx = unseen[self._rng.integers(unseen.size)]
+            action = np.zeros(len(self.counts), dtype=np.float32)
             action[idx] = 1
         else:
+            self._all_seen = True
             min_time_steps = min(self.total_time_steps, self.window_size)
-            recent_values = self.recent_rewards_sum / self.recent_counts_sum
-            ucb_values = recent_values + self.c * np.sqrt(
-                2 * np.log(min_time_steps) / self.recent_counts_sum)
-            action = ucb_values
+            # a fresh array, env.step adds its noise to the action in place
+            action = sliding_window_ucb_scores(self.recent_rewards_sum, self.recent_counts_sum,
+                                               np.log(min_time_steps), self.c,
+                                               np.empty(len(self.counts), dtype=np.float32))
         return action
 
     def update(self, actions, state):
         self.total_time_steps += 1
-        for i, reward in enumerate(state):
-            if reward >= 0:
-                self.counts[i] += 1
-
-                if len(self.recent_rewards[i]) == self.window_size:
-                    self.recent_rewards_sum[i] -= self.recent_rewards[i][0]
-                    self.recent_counts_sum[i] -= self.recent_counts[i][0]
-
-                self.recent_rewards[i].append(reward)
-                self.recent_counts[i].append(1)
-                self.recent_rewards_sum[i] += reward
-                self.recent_counts_sum[i] += 1
-            else:
-                self.counts[i] += 0
-                self.recent_rewards[i].append(0)
-                self.recent_counts[i].append(0)
+        state = np.asarray(state, dtype=np.float32)
+        mask = state >= 0
+        rewards = np.where(mask, state, 0)
+        self.counts += mask
+
+        # replace the step that leaves the window (all zeros until the window is full)
+        self.recent_rewards_sum += rewards - self.recent_rewards[self.head]
+        self.recent_counts_sum += mask - self.recent_counts[self.head]
+        self.recent_rewards[self.head] = rewards
+        self.recent_counts[self.head] = mask
+        self.head = (self.head + 1) % self.window_size
 
 
 class DiscountedUCBAgent:
@@ -140,49 +248,64 @@ class DiscountedUCBAgent:
     ----------
     gamma : float
         Discount factor for past rewards and counts.
+    seed : int, optional
+        Seed of the agent's random generator, drawn from the global NumPy state if omitted.
     """
-    def __init__(self, gamma=0.9):
+    def __init__(self, gamma=0.9, seed=None):
         self.counts = None
         self.discounted_counts = None
         self.values = None
         self.discounted_rewards = None
         self.c = 3
         self.gamma = gamma
+        self._scale = 1.0
+        self._scratch = None
+        self._all_seen = False
+        self._rng = make_rng(seed)
         self.total_time_steps = 0
 
     def initialize(self, n_actions):
-        self.counts = np.zeros(n_actions)
-        self.discounted_counts = np.zeros(n_actions)
-        self.values = np.zeros(n_actions)
-        self.discounted_rewards = np.zeros(n_actions)
+        self.counts = np.zeros(n_actions, dtype=np.float32)
+        self.discounted_counts = np.zeros(n_actions, dtype=np.float32)
+        self.values = np.zeros(n_actions, dtype=np.float32)
+        self.discounted_rewards = np.zeros(n_actions, dtype=np.float32)
+        self._scale = 1.0
+        # work buffer for the exploration term in get_action
+        self._scratch = np.empty(n_actions, dtype=np.float32)
+        self._all_seen = False
 
     def get_action(self):
-        if self.counts.min() == 0:
-            idx = np.random.choice(np.where(self.counts == 0)[0])
-            action = np.zeros(len(self.values))
+        # counts never decrease, so the scan for unseen arms stops once all have been seen
+        if not self._all_seen and self.counts.min() == 0:
+            unseen = np.flatnonzero(self.counts == 0)
+            idx = unseen[self._rng.integers(unseen.size)]
+            action = np.zeros(len(self.values), dtype=np.float32)
             action[idx] = 1
         else:
+            self._all_seen = True
+            # the means do not depend on the common scale of the discounted sums
             discounted_means = self.discounted_rewards / self.discounted_counts
-            ct_numerator = 2 * np.log(self.total_time_steps)
-            ct_denominator = self.discounted_counts
-            ct = self.c * np.sqrt(np.maximum(ct_numerator / ct_denominator, 0))
-            action = discounted_means + ct
+            ct_numerator = 2 * np.log(self.total_time_steps) / self._scale
+            np.divide(ct_numerator, self.discounted_counts, out=self._scratch)
+            np.maximum(self._scratch, 0, out=self._scratch)
+            np.sqrt(self._scratch, out=self._scratch)
+            self._scratch *= self.c
+            action = discounted_means + self._scratch
         return action
 
     def update(self, actions, state):
         self.total_time_steps = self.gamma*self.total_time_steps + 1
-        self.discounted_counts *= self.gamma
-        self.discounted_rewards *= self.gamma
-
-        for i, reward in enumerate(state):
-            if reward >= 0:
-                self.counts[i] += 1
-                self.values[i] += reward
-
-                self.discounted_counts[i] += 1
-                self.discounted_rewards[i] += reward
-            else:
-                self.counts[i] += 0
+        # the discounted sums are kept unscaled: the true values are _scale * sums with
+        # _scale = gamma^t, so instead of decaying every arm each step, new observations
+        # are added with weight 1 / _scale
+        self._scale *= self.gamma
+        discounted_ucb_update(self.counts, self.values, self.discounted_counts, self.discounted_rewards,
+                              np.asarray(state, dtype=np.float32), 1 / self._scale)
+        # fold the scale back into the sums before the weights overflow float32
+        if self._scale < 1e-30:
+            self.discounted_counts *= self._scale
+            self.discounted_rewards *= self._scale
+            self._scale = 1.0
 
 
 class UCBAgent:
@@ -191,37 +314,43 @@ class UCBAgent:
 
     Attributes
     ----------
-    None
+    seed : int, optional
+        Seed of the agent's random generator, drawn from the global NumPy state if omitted.
     """
-    def __init__(self):
+    def __init__(self, seed=None):
         self.counts = None
         self.values = None
         self.c = 3
+        self._scratch = None
+        self._all_seen = False
+        self._rng = make_rng(seed)
         self.total_time_steps = 0
 
     def initialize(self, n_actions):
-        self.counts = np.zeros(n_actions)
-        self.values = np.zeros(n_actions)
+        self.counts = np.zeros(n_actions, dtype=np.float32)
+        self.values = np.zeros(n_actions, dtype=np.float32)
+        # work buffer for the exploration term in get_action
+        self._scratch = np.empty(n_actions, dtype=np.float32)
+        self._all_seen = False
 
     def get_action(self):
-        if self.counts.min() == 0:
-        # action = np.random. choice(np.where(self.counts == 0) [0])
-            idx = np.random.choice(np.where(self.counts == 0)[0])
-            action = np.zeros(len(self.values))
+        # counts never decrease, so the scan for unseen arms stops once all have been seen
+        if not self._all_seen and self.counts.min() == 0:
+            unseen = np.flatnonzero(self.counts == 0)
+            idx = unseen[self._rng.integers(unseen.size)]
+            action = np.zeros(len(self.values), dtype=np.float32)
             action[idx] = 1
         else:
-            ucb_values = self.values + self.c * np.sqrt(2 * np.log(self.total_time_steps) / self.counts)
-            action = ucb_values
+            self._all_seen = True
+            np.divide(2 * np.log(self.total_time_steps), self.counts, out=self._scratch)
+            np.sqrt(self._scratch, out=self._scratch)
+            self._scratch *= self.c
+            action = self.values + self._scratch
         return action
 
     def update(self, actions, state):
         self.total_time_steps += 1
-        for i, reward in enumerate(state):
-            if reward >= 0:
-                self.counts[i] += 1
-                self.values[i] = self.values[i] + (1 / self.counts[i]) * (reward - self.values[i])
-            else:
-                self.counts[i] += 0
+        ucb_update(self.counts, self.values, np.asarray(state, dtype=np.float32))
 
 class LSTM_Agent(nn.Module):
     """
@@ -240,18 +369,19 @@ class LSTM_Agent(nn.Module):
         super(LSTM_Agent, self).__init__()
         self.lstm = nn.LSTM(input_size, hidden_size, batch_first=True)
         self.dense = nn.Linear(hidden_size, output_size)
-        self.records = [[] for _ in range(input_size)]
         self.hidden_size = hidden_size
 
-    def forward(self, state, hidden_cell):
+    def forward(self, state: torch.Tensor, hidden_cell: Tuple[torch.Tensor, torch.Tensor]):
         x, hidden_cell = self.lstm(state, hidden_cell)
         x = x[:, -1, :]
         x = self.dense(x)
         return x, hidden_cell
 
     def init_hidden_cell_states(self, batch_size):
-        hidden_state = torch.zeros(1, batch_size, self.hidden_size).to(device)
-        cell_state = torch.zeros(1, batch_size, self.hidden_size).to(device)
+        # match the parameter dtype so reduced-precision models get matching states
+        dtype = self.dense.weight.dtype
+        hidden_state = torch.zeros(1, batch_size, self.hidden_size, dtype=dtype).to(device)
+        cell_state = torch.zeros(1, batch_size, self.hidden_size, dtype=dtype).to(device)
         return hidden_state, cell_state
 
 
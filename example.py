@@ -23,7 +23,7 @@ for theta in range(5):
     init_action = np.random.rand(env.n_camera)
     reward, state, stop = env.step(init_action)
 
-    for t in tqdm(range(env.length), initial=2):
+    for t in tqdm(range(env.length), initial=2, mininterval=0.5, miniters=max(1, env.length // 200)):
 
         action = agent.get_action(state)
         reward, state, stop = env.step(action)
@@ -50,7 +50,7 @@ agent = baselineAgent(theta=best_theta)
 init_action = np.random.rand(env.n_camera)
 reward, state, stop = env.step(init_action)
 
-for t in tqdm(range(env.length), initial=2):
+for t in tqdm(range(env.length), initial=2, mininterval=0.5, miniters=max(1, env.length // 200)):
 
     action = agent.get_action(state)
     reward, state, stop = env.step(action)
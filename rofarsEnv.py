@@ -13,7 +13,10 @@ class ROFARS_v1:
         self.train_cameras, self.test_cameras = self.init_cameras(data_path)
         self.reset()
 
-    def reset(self, mode='train'):
+    def reset(self, mode='train', budget_ratio=None):
+        # optionally change the budget without reloading the camera streams
+        if budget_ratio is not None:
+            self.budget_ratio = budget_ratio
         # train/test mode
         if mode == 'train':
             self.cameras = self.train_cameras
@@ -42,6 +45,7 @@ class ROFARS_v1:
     def step(self, action):
         assert len(action) == self.n_camera
         # adding small noise to the action for randomness when all values are the same
+        # (in place: agents must hand over an array they do not reuse for their own state)
         action += np.random.rand(*action.shape)/100
         # action is a vector of scores with n_camera-dimension
         # -1 refers to the unchecked camera state